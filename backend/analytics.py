@@ -0,0 +1,174 @@
+"""Analytics aggregations over the OpenFlights collections"""
+import asyncio
+
+# Largest limit each analytics endpoint accepts, precomputed into the cache
+CACHE_LIMITS = {
+    'busiest_airports': 50,
+    'top_airlines': 50,
+    'popular_routes': 50,
+    'airports_by_country': 100
+}
+
+def busiest_airports_pipeline(limit):
+    """Busiest airports by route count"""
+    return [
+        {"$group": {"_id": "$dest_id", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "airports",
+            "localField": "_id",
+            "foreignField": "id",
+            "as": "airport"
+        }},
+        {"$unwind": "$airport"},
+        {"$project": {
+            "_id": 0,
+            "airport_id": "$_id",
+            "name": "$airport.name",
+            "city": "$airport.city",
+            "country": "$airport.country",
+            "iata": "$airport.iata",
+            "routes": "$count"
+        }}
+    ]
+
+def top_airlines_pipeline(limit):
+    """Top airlines by route count"""
+    return [
+        {"$match": {"airline_id": {"$ne": None}}},
+        {"$group": {"_id": "$airline_id", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "airlines",
+            "localField": "_id",
+            "foreignField": "id",
+            "as": "airline"
+        }},
+        {"$unwind": "$airline"},
+        {"$project": {
+            "_id": 0,
+            "airline_id": "$_id",
+            "name": "$airline.name",
+            "iata": "$airline.iata",
+            "country": "$airline.country",
+            "routes": "$count"
+        }}
+    ]
+
+def popular_routes_pipeline(limit):
+    """Most popular routes by number of airlines flying them"""
+    return [
+        {"$group": {
+            "_id": {"source_id": "$source_id", "dest_id": "$dest_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "airports",
+            "localField": "_id.source_id",
+            "foreignField": "id",
+            "as": "source_airport"
+        }},
+        {"$lookup": {
+            "from": "airports",
+            "localField": "_id.dest_id",
+            "foreignField": "id",
+            "as": "dest_airport"
+        }},
+        {"$project": {
+            "_id": 0,
+            "source": {"$arrayElemAt": ["$source_airport.iata", 0]},
+            "source_name": {"$arrayElemAt": ["$source_airport.name", 0]},
+            "dest": {"$arrayElemAt": ["$dest_airport.iata", 0]},
+            "dest_name": {"$arrayElemAt": ["$dest_airport.name", 0]},
+            "airlines": "$count"
+        }}
+    ]
+
+def airports_by_country_pipeline(limit):
+    """Airport count by country"""
+    return [
+        {"$match": {"country": {"$ne": None}}},
+        {"$group": {"_id": "$country", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "country": "$_id", "airports": "$count"}}
+    ]
+
+# Cache key -> (source collection, pipeline builder)
+PIPELINES = {
+    'busiest_airports': ('routes', busiest_airports_pipeline),
+    'top_airlines': ('routes', top_airlines_pipeline),
+    'popular_routes': ('routes', popular_routes_pipeline),
+    'airports_by_country': ('airports', airports_by_country_pipeline)
+}
+
+async def _aggregate(collection, pipeline, length):
+    """Run an aggregation pipeline and collect up to length results"""
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(length=length)
+
+async def compute_stats(db):
+    """Compute overall dataset statistics"""
+    countries_pipeline = [
+        {"$match": {"country": {"$nin": [None, ""]}}},
+        {"$group": {"_id": "$country"}},
+        {"$count": "n"}
+    ]
+
+    # Independent queries, so run them together; counts come from collection metadata
+    total_airports, total_airlines, total_routes, countries = await asyncio.gather(
+        db.airports.estimated_document_count(),
+        db.airlines.estimated_document_count(),
+        db.routes.estimated_document_count(),
+        _aggregate(db.airports, countries_pipeline, 1)
+    )
+    total_countries = countries[0]['n'] if countries else 0
+
+    return {
+        'total_airports': total_airports,
+        'total_airlines': total_airlines,
+        'total_routes': total_routes,
+        'total_countries': total_countries
+    }
+
+async def compute_analytics(db, key, limit):
+    """Run the aggregation behind an analytics endpoint"""
+    collection, pipeline = PIPELINES[key]
+    return await _aggregate(db[collection], pipeline(limit), limit)
+
+async def get_analytics(db, key, limit):
+    """Serve analytics from the cache, falling back to a live aggregation"""
+    cached = await db.analytics_cache.find_one({"key": key})
+    if cached:
+        return cached['data'][:limit]
+    return await compute_analytics(db, key, limit)
+
+async def get_cached_stats(db):
+    """Serve overall statistics from the cache, falling back to live counts"""
+    cached = await db.analytics_cache.find_one({"key": "stats"})
+    if cached:
+        return cached['data']
+    return await compute_stats(db)
+
+async def clear_analytics_cache(db):
+    """Invalidate all cached analytics"""
+    await db.analytics_cache.drop()
+
+async def build_analytics_cache(db):
+    """Precompute every analytics result into the analytics_cache collection"""
+    keys = list(CACHE_LIMITS)
+    stats, *results = await asyncio.gather(
+        compute_stats(db),
+        *(compute_analytics(db, key, CACHE_LIMITS[key]) for key in keys)
+    )
+
+    await clear_analytics_cache(db)
+    await db.analytics_cache.insert_many(
+        [{'key': 'stats', 'data': stats}] +
+        [{'key': key, 'data': data} for key, data in zip(keys, results)]
+    )
+    await db.analytics_cache.create_index('key', unique=True)
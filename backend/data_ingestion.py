@@ -1,88 +1,179 @@
 """Data ingestion script for OpenFlights dataset"""
 import asyncio
 import os
+from itertools import islice
 import pandas as pd
 import numpy as np
-import pickle
-from motor.motor_asyncio import AsyncIOMotorClient
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import joblib
+from pymongo.write_concern import WriteConcern
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 import logging
-from pathlib import Path
-from dotenv import load_dotenv
-
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
+from analytics import build_analytics_cache, clear_analytics_cache
+from database import ROOT_DIR, get_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+DATA_DIR = ROOT_DIR / 'data'
+
+# Route similarity index files read by the recommendation endpoint
+VECTORIZER_PATH = DATA_DIR / 'tfidf.joblib'
+ROUTES_TABLE_PATH = DATA_DIR / 'routes.arrow'
+EMBEDDINGS_PATH = DATA_DIR / 'embeddings.npz'
+
+ROUTES_BATCH_SIZE = 10000
+MAX_CONCURRENT_INSERTS = 8
+
+def bulk_collection(name):
+    """Get an unacknowledged (w=0) collection handle for one-shot bulk loads"""
+    return get_db().get_collection(name, write_concern=WriteConcern(w=0))
+
+def read_dat(filename, cols):
+    """Read an OpenFlights .dat file into an Arrow-backed DataFrame"""
+    table = pacsv.read_csv(
+        DATA_DIR / filename,
+        read_options=pacsv.ReadOptions(column_names=cols),
+        parse_options=pacsv.ParseOptions(delimiter=','),
+        convert_options=pacsv.ConvertOptions(null_values=['\\N', ''], strings_can_be_null=True)
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def column_values(series):
+    """Convert a column to a list of native Python values with None for nulls"""
+    return series.astype(object).where(series.notna(), None).tolist()
 
-DATA_DIR = Path(__file__).parent / 'data'
+def encode_embedding(embeddings, row):
+    """Encode one sparse int8 embedding row as uint16 index and int8 value bytes"""
+    start, end = embeddings.indptr[row], embeddings.indptr[row + 1]
+    return {
+        'indices': embeddings.indices[start:end].astype('<u2').tobytes(),
+        'values': embeddings.data[start:end].astype(np.int8).tobytes()
+    }
+
+def decode_embeddings(indices, values, lengths, dim):
+    """Rebuild a sparse int8 CSR matrix from concatenated encode_embedding bytes and row lengths"""
+    return sparse.csr_matrix((
+        np.frombuffer(values, dtype=np.int8),
+        np.frombuffer(indices, dtype='<u2'),
+        np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    ), shape=(len(lengths), dim))
+
+def save_route_index(df, vectorizer, embeddings):
+    """Write route metadata as Arrow IPC, sparse embeddings as .npz and the fitted vectorizer"""
+    table = pa.Table.from_pandas(df[['route_text', 'source', 'dest', 'airline']], preserve_index=False)
+    # Write to a temporary file and rename it, so a server that has the old file
+    # memory-mapped keeps reading the old contents instead of a truncated file
+    tmp_path = ROUTES_TABLE_PATH.with_suffix('.arrow.tmp')
+    with pa.OSFile(str(tmp_path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, ROUTES_TABLE_PATH)
+    sparse.save_npz(EMBEDDINGS_PATH, embeddings)
+    joblib.dump(vectorizer, VECTORIZER_PATH)
+
+async def insert_batches(collection, records, batch_size, max_in_flight):
+    """Insert records in batches, building the next batch while earlier ones are written"""
+    # A slot is taken before each batch is built, so at most max_in_flight
+    # batches are held in memory
+    semaphore = asyncio.Semaphore(max_in_flight)
+    
+    async def insert_batch(batch):
+        try:
+            await collection.insert_many(batch, ordered=False)
+        finally:
+            semaphore.release()
+    
+    tasks = []
+    while True:
+        await semaphore.acquire()
+        batch = list(islice(records, batch_size))
+        if not batch:
+            semaphore.release()
+            break
+        tasks.append(asyncio.create_task(insert_batch(batch)))
+        # acquire() does not yield while a slot is free, so hand control to the
+        # new task and let its write start before the next batch is built
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
 
 async def ingest_airports():
     """Ingest airports data"""
+    db = get_db()
     logger.info("Ingesting airports...")
     cols = ['id', 'name', 'city', 'country', 'iata', 'icao', 'latitude', 'longitude', 
             'altitude', 'timezone', 'dst', 'tz', 'type', 'source']
     
-    df = pd.read_csv(DATA_DIR / 'airports.dat', header=None, names=cols, na_values='\\N')
+    df = read_dat('airports.dat', cols)
     df = df[['id', 'name', 'city', 'country', 'iata', 'icao', 'latitude', 'longitude']]
     df = df.dropna(subset=['id'])
     df['id'] = df['id'].astype(int)
     
-    # Clear existing data
-    await db.airports.delete_many({})
+    # Lowercase mirrors so airport search can use anchored, indexable prefix matches
+    for field in ['name', 'city', 'country']:
+        df[f'{field}_lc'] = df[field].str.lower()
+    
+    # Drop existing data and indexes so the bulk load skips index maintenance
+    await db.airports.drop()
     
     # Insert data
     records = df.to_dict('records')
     if records:
-        await db.airports.insert_many(records)
+        await bulk_collection('airports').insert_many(records, ordered=False)
     
-    # Create indexes
-    await db.airports.create_index('id', unique=True)
-    await db.airports.create_index('iata')
-    await db.airports.create_index('country')
+    # Create indexes concurrently
+    await asyncio.gather(
+        db.airports.create_index('id', unique=True),
+        db.airports.create_index('iata'),
+        db.airports.create_index('country'),
+        db.airports.create_index([('name', 'text'), ('city', 'text'), ('country', 'text'), ('iata', 'text')]),
+        db.airports.create_index('name_lc'),
+        db.airports.create_index('city_lc'),
+        db.airports.create_index('country_lc')
+    )
     
     logger.info(f"Ingested {len(records)} airports")
     return len(records)
 
 async def ingest_airlines():
     """Ingest airlines data"""
+    db = get_db()
     logger.info("Ingesting airlines...")
     cols = ['id', 'name', 'alias', 'iata', 'icao', 'callsign', 'country', 'active']
     
-    df = pd.read_csv(DATA_DIR / 'airlines.dat', header=None, names=cols, na_values='\\N')
+    df = read_dat('airlines.dat', cols)
     df = df.dropna(subset=['id'])
     df['id'] = df['id'].astype(int)
-    df['active'] = df['active'] == 'Y'
+    df['active'] = df['active'].eq('Y').fillna(False)
     
-    # Clear existing data
-    await db.airlines.delete_many({})
+    # Drop existing data and indexes so the bulk load skips index maintenance
+    await db.airlines.drop()
     
     # Insert data
     records = df.to_dict('records')
     if records:
-        await db.airlines.insert_many(records)
+        await bulk_collection('airlines').insert_many(records, ordered=False)
     
-    # Create indexes
-    await db.airlines.create_index('id', unique=True)
-    await db.airlines.create_index('iata')
-    await db.airlines.create_index('country')
+    # Create indexes concurrently
+    await asyncio.gather(
+        db.airlines.create_index('id', unique=True),
+        db.airlines.create_index('iata'),
+        db.airlines.create_index('country')
+    )
     
     logger.info(f"Ingested {len(records)} airlines")
     return len(records)
 
 async def ingest_routes_with_embeddings():
     """Ingest routes and compute TF-IDF embeddings"""
+    db = get_db()
     logger.info("Ingesting routes with embeddings...")
     cols = ['airline', 'airline_id', 'source', 'source_id', 'dest', 'dest_id', 
             'codeshare', 'stops', 'equipment']
     
-    df = pd.read_csv(DATA_DIR / 'routes.dat', header=None, names=cols, na_values='\\N')
+    df = read_dat('routes.dat', cols)
     df = df.dropna(subset=['source_id', 'dest_id'])
     df['source_id'] = df['source_id'].astype(int)
     df['dest_id'] = df['dest_id'].astype(int)
@@ -93,59 +184,105 @@ async def ingest_routes_with_embeddings():
     # Compute TF-IDF embeddings
     logger.info("Computing TF-IDF embeddings...")
     vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 5), max_features=128)
+    # TfidfVectorizer already returns L2-normalized CSR rows
     vectors = vectorizer.fit_transform(df['route_text'])
-    dense = vectors.toarray()
-    
-    # Clear existing data
-    await db.routes.delete_many({})
-    
-    # Insert routes with embeddings
-    records = []
-    for idx, (i, row) in enumerate(df.iterrows()):
-        emb = dense[idx]
-        emb_bytes = pickle.dumps(emb, protocol=4)
-        
-        record = {
+    
+    # Quantize the non-zero weights to int8 without densifying; TF-IDF weights lie
+    # in [0, 1] and cosine similarity ignores the scale. Rounding shifts similarity
+    # scores by up to ~5e-3, enough to reorder near-ties in the top-k
+    scale = 127 / vectors.max()
+    quantized = vectors.copy()
+    quantized.data = np.round(quantized.data * scale).astype(np.int8)
+    quantized.eliminate_zeros()
+    
+    # Drop existing data and indexes so the bulk load skips index maintenance
+    await db.routes.drop()
+    
+    # Coerce columns once instead of per row
+    df['stops'] = df['stops'].fillna(0).astype(int)
+    columns = zip(
+        column_values(df['airline']),
+        column_values(df['airline_id']),
+        column_values(df['source']),
+        column_values(df['source_id']),
+        column_values(df['dest']),
+        column_values(df['dest_id']),
+        column_values(df['codeshare']),
+        column_values(df['stops']),
+        column_values(df['equipment']),
+        column_values(df['route_text'])
+    )
+    
+    # Persist the fitted vectorizer and embeddings for the recommendation endpoint
+    save_route_index(df, vectorizer, quantized)
+    
+    # Build route records with embeddings lazily, one batch at a time
+    records = (
+        {
             'id': idx + 1,
-            'airline': row['airline'],
-            'airline_id': int(row['airline_id']) if pd.notnull(row['airline_id']) else None,
-            'source': row['source'],
-            'source_id': int(row['source_id']),
-            'dest': row['dest'],
-            'dest_id': int(row['dest_id']),
-            'codeshare': row['codeshare'] if pd.notnull(row['codeshare']) else None,
-            'stops': int(row['stops']) if pd.notnull(row['stops']) else 0,
-            'equipment': row['equipment'] if pd.notnull(row['equipment']) else None,
-            'route_text': row['route_text'],
-            'embedding': emb_bytes
+            'airline': airline,
+            'airline_id': airline_id,
+            'source': source,
+            'source_id': source_id,
+            'dest': dest,
+            'dest_id': dest_id,
+            'codeshare': codeshare,
+            'stops': stops,
+            'equipment': equipment,
+            'route_text': route_text,
+            'embedding': encode_embedding(quantized, idx)
         }
-        records.append(record)
-        
-        # Batch insert every 1000 records
-        if len(records) >= 1000:
-            await db.routes.insert_many(records)
-            records = []
-    
-    # Insert remaining records
-    if records:
-        await db.routes.insert_many(records)
+        for idx, (airline, airline_id, source, source_id, dest, dest_id,
+                  codeshare, stops, equipment, route_text) in enumerate(columns)
+    )
+    
+    # Indexes are created after the bulk load
+    await insert_batches(bulk_collection('routes'), records, ROUTES_BATCH_SIZE, MAX_CONCURRENT_INSERTS)
     
-    # Create indexes
-    await db.routes.create_index('id', unique=True)
-    await db.routes.create_index('source_id')
-    await db.routes.create_index('dest_id')
-    await db.routes.create_index('airline_id')
+    # Create indexes concurrently
+    await asyncio.gather(
+        db.routes.create_index('id', unique=True),
+        db.routes.create_index([('source', 1), ('dest', 1)]),
+        db.routes.create_index([('source_id', 1), ('dest_id', 1)]),
+        db.routes.create_index('dest_id'),
+        db.routes.create_index('airline_id')
+    )
     
     logger.info(f"Ingested {len(df)} routes with embeddings")
     return len(df)
 
+async def wait_for_documents(name, expected, timeout=60):
+    """Wait until unacknowledged bulk writes to a collection have all been applied"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while (count := await get_db()[name].count_documents({})) < expected:
+        if loop.time() > deadline:
+            # w=0 inserts report no errors, so a short count is the only sign of lost writes
+            raise RuntimeError(f"Only {count} of {expected} documents landed in {name} after {timeout}s")
+        await asyncio.sleep(0.5)
+
 async def run_full_ingestion():
     """Run complete data ingestion pipeline"""
+    db = get_db()
     logger.info("Starting full data ingestion...")
+    await clear_analytics_cache(db)
+    
+    # Stages touch disjoint collections, so let their Mongo I/O overlap
+    airports_count, airlines_count, routes_count = await asyncio.gather(
+        ingest_airports(),
+        ingest_airlines(),
+        ingest_routes_with_embeddings()
+    )
     
-    airports_count = await ingest_airports()
-    airlines_count = await ingest_airlines()
-    routes_count = await ingest_routes_with_embeddings()
+    # Precompute analytics once the bulk loads have landed; a short load raises
+    # before the cache is built
+    await asyncio.gather(
+        wait_for_documents('airports', airports_count),
+        wait_for_documents('airlines', airlines_count),
+        wait_for_documents('routes', routes_count)
+    )
+    logger.info("Building analytics cache...")
+    await build_analytics_cache(db)
     
     logger.info(f"Ingestion complete: {airports_count} airports, {airlines_count} airlines, {routes_count} routes")
     return {
@@ -0,0 +1,29 @@
+"""MongoDB client shared by the API and the data ingestion pipeline"""
+import functools
+import os
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+
+ROOT_DIR = Path(__file__).parent
+
+@functools.lru_cache(maxsize=1)
+def load_env():
+    """Load backend/.env into the environment once"""
+    load_dotenv(ROOT_DIR / '.env')
+
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """Create the process-wide MongoDB client on first use"""
+    load_env()
+    return AsyncMongoClient(os.environ['MONGO_URL'], maxPoolSize=50)
+
+def get_db():
+    """Get the application database from the shared client"""
+    return get_client()[os.environ['DB_NAME']]
+
+async def close_client():
+    """Close the shared client, if one was created"""
+    if get_client.cache_info().currsize:
+        await get_client().close()
+        get_client.cache_clear()
@@ -1,24 +1,31 @@
 from fastapi import FastAPI, APIRouter, Query, HTTPException
-from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import re
 import logging
-from pathlib import Path
+from array import array
 from pydantic import BaseModel
+from pymongo.errors import OperationFailure
 from typing import List, Optional, Dict, Any
-import pickle
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import joblib
+import pyarrow as pa
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+from analytics import get_analytics, get_cached_stats
+from database import close_client, get_db, load_env
+from data_ingestion import (
+    EMBEDDINGS_PATH, ROUTES_TABLE_PATH, VECTORIZER_PATH, decode_embeddings, run_full_ingestion
+)
 
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
+# CORS settings below are read from the environment at import time
+load_env()
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Route similarity index written by data_ingestion, loaded once at startup
+EMBEDDING_DIM = 128
+ROUTE_INDEX_BATCH_SIZE = 2000
+route_index: Dict[str, Any] = {}
 
 # Create the main app
 app = FastAPI(title="Flight Analytics API")
@@ -31,12 +38,6 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Models
-class Stats(BaseModel):
-    total_airports: int
-    total_airlines: int
-    total_routes: int
-    total_countries: int
-
 class Airport(BaseModel):
     id: int
     name: str
@@ -51,152 +52,128 @@ class Route(BaseModel):
     airline: Optional[str] = None
 
 # Analytics Endpoints
-@api_router.get("/analytics/stats", response_model=Stats)
+@api_router.get("/analytics/stats")
 async def get_stats():
     """Get overall statistics"""
-    total_airports = await db.airports.count_documents({})
-    total_airlines = await db.airlines.count_documents({})
-    total_routes = await db.routes.count_documents({})
-    
-    # Count distinct countries
-    countries = await db.airports.distinct('country')
-    total_countries = len([c for c in countries if c])
-    
-    return Stats(
-        total_airports=total_airports,
-        total_airlines=total_airlines,
-        total_routes=total_routes,
-        total_countries=total_countries
-    )
+    return await get_cached_stats(get_db())
 
 @api_router.get("/analytics/busiest-airports")
 async def get_busiest_airports(limit: int = Query(10, ge=1, le=50)):
     """Get busiest airports by route count"""
-    pipeline = [
-        {"$group": {"_id": "$dest_id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": limit},
-        {"$lookup": {
-            "from": "airports",
-            "localField": "_id",
-            "foreignField": "id",
-            "as": "airport"
-        }},
-        {"$unwind": "$airport"},
-        {"$project": {
-            "_id": 0,
-            "airport_id": "$_id",
-            "name": "$airport.name",
-            "city": "$airport.city",
-            "country": "$airport.country",
-            "iata": "$airport.iata",
-            "routes": "$count"
-        }}
-    ]
-    
-    results = await db.routes.aggregate(pipeline).to_list(length=limit)
-    return results
+    return await get_analytics(get_db(), 'busiest_airports', limit)
 
 @api_router.get("/analytics/top-airlines")
 async def get_top_airlines(limit: int = Query(10, ge=1, le=50)):
     """Get top airlines by route count"""
-    pipeline = [
-        {"$match": {"airline_id": {"$ne": None}}},
-        {"$group": {"_id": "$airline_id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": limit},
-        {"$lookup": {
-            "from": "airlines",
-            "localField": "_id",
-            "foreignField": "id",
-            "as": "airline"
-        }},
-        {"$unwind": "$airline"},
-        {"$project": {
-            "_id": 0,
-            "airline_id": "$_id",
-            "name": "$airline.name",
-            "iata": "$airline.iata",
-            "country": "$airline.country",
-            "routes": "$count"
-        }}
-    ]
-    
-    results = await db.routes.aggregate(pipeline).to_list(length=limit)
-    return results
+    return await get_analytics(get_db(), 'top_airlines', limit)
 
 @api_router.get("/analytics/popular-routes")
 async def get_popular_routes(limit: int = Query(10, ge=1, le=50)):
     """Get most popular routes"""
-    pipeline = [
-        {"$group": {
-            "_id": {"source_id": "$source_id", "dest_id": "$dest_id"},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"count": -1}},
-        {"$limit": limit},
-        {"$lookup": {
-            "from": "airports",
-            "localField": "_id.source_id",
-            "foreignField": "id",
-            "as": "source_airport"
-        }},
-        {"$lookup": {
-            "from": "airports",
-            "localField": "_id.dest_id",
-            "foreignField": "id",
-            "as": "dest_airport"
-        }},
-        {"$project": {
-            "_id": 0,
-            "source": {"$arrayElemAt": ["$source_airport.iata", 0]},
-            "source_name": {"$arrayElemAt": ["$source_airport.name", 0]},
-            "dest": {"$arrayElemAt": ["$dest_airport.iata", 0]},
-            "dest_name": {"$arrayElemAt": ["$dest_airport.name", 0]},
-            "airlines": "$count"
-        }}
-    ]
-    
-    results = await db.routes.aggregate(pipeline).to_list(length=limit)
-    return results
+    return await get_analytics(get_db(), 'popular_routes', limit)
 
 @api_router.get("/analytics/airports-by-country")
 async def get_airports_by_country(limit: int = Query(20, ge=1, le=100)):
     """Get airport count by country"""
-    pipeline = [
-        {"$match": {"country": {"$ne": None}}},
-        {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": limit},
-        {"$project": {"_id": 0, "country": "$_id", "airports": "$count"}}
-    ]
-    
-    results = await db.airports.aggregate(pipeline).to_list(length=limit)
-    return results
+    return await get_analytics(get_db(), 'airports_by_country', limit)
 
 # Search Endpoints
 @api_router.get("/search/airports")
 async def search_airports(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100)):
-    """Search airports by name, city, or IATA code"""
-    regex = {"$regex": q, "$options": "i"}
+    """Search airports by name, city, country, or IATA code"""
+    db = get_db()
+    projection = {"_id": 0, "name_lc": 0, "city_lc": 0, "country_lc": 0}
+    
+    # Whole-word matches come from the text index, ranked by relevance; databases
+    # ingested before the index existed go straight to the prefix fallback
+    try:
+        airports = await db.airports.find(
+            {"$text": {"$search": q}}, projection
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(length=limit)
+    except OperationFailure as e:
+        logger.warning(f"Airport text search unavailable, using prefix match: {e}")
+        airports = []
+    if airports:
+        return airports
+    
+    # Fall back to anchored prefix matches, which can still use the indexes
+    prefix = f"^{re.escape(q.lower())}"
     query = {"$or": [
-        {"name": regex},
-        {"city": regex},
-        {"iata": regex},
-        {"country": regex}
+        {"name_lc": {"$regex": prefix}},
+        {"city_lc": {"$regex": prefix}},
+        {"iata": {"$regex": f"^{re.escape(q.upper())}"}},
+        {"country_lc": {"$regex": prefix}}
     ]}
     
-    airports = await db.airports.find(query, {"_id": 0}).limit(limit).to_list(length=limit)
+    airports = await db.airports.find(query, projection).limit(limit).to_list(length=limit)
     return airports
 
 @api_router.get("/search/routes/{airport_id}")
 async def get_routes_by_airport(airport_id: int, limit: int = Query(50, ge=1, le=200)):
     """Get routes from/to an airport"""
+    db = get_db()
     query = {"$or": [{"source_id": airport_id}, {"dest_id": airport_id}]}
     routes = await db.routes.find(query, {"_id": 0, "embedding": 0}).limit(limit).to_list(length=limit)
     return routes
 
 # Recommendations Endpoint
+def l2_normalize(vectors):
+    """L2-normalize sparse rows into float32 CSR so cosine similarity is a dot product"""
+    return normalize(sparse.csr_matrix(vectors, dtype=np.float32), norm='l2', copy=False)
+
+def load_route_index():
+    """Load the persisted route similarity index, if ingestion has written one"""
+    route_index.clear()
+    if not all(path.exists() for path in (VECTORIZER_PATH, ROUTES_TABLE_PATH, EMBEDDINGS_PATH)):
+        return
+    
+    # Route metadata stays a memory-mapped Arrow table; rows are only materialized
+    # for the top-k results of each query
+    route_index['vectorizer'] = joblib.load(VECTORIZER_PATH)
+    route_index['embeddings'] = l2_normalize(sparse.load_npz(EMBEDDINGS_PATH))
+    route_index['route_info'] = pa.ipc.open_file(pa.memory_map(str(ROUTES_TABLE_PATH))).read_all()
+    logger.info(f"Loaded route index with {route_index['route_info'].num_rows} routes")
+
+async def build_route_index():
+    """Build the route similarity index from MongoDB when no persisted index exists"""
+    db = get_db()
+    
+    # Stream only the needed fields, appending the stored embedding bytes to flat
+    # CSR buffers and route metadata column by column
+    query = {"embedding": {"$exists": True}}
+    projection = {"_id": 0, "embedding": 1, "route_text": 1, "source": 1, "dest": 1, "airline": 1}
+    indices = bytearray()
+    values = bytearray()
+    lengths = array('I')
+    route_info = {'route_text': [], 'source': [], 'dest': [], 'airline': []}
+    async for route in db.routes.find(query, projection).batch_size(ROUTE_INDEX_BATCH_SIZE):
+        embedding = route['embedding']
+        indices += embedding['indices']
+        values += embedding['values']
+        lengths.append(len(embedding['values']))
+        route_info['route_text'].append(route['route_text'])
+        route_info['source'].append(route['source'])
+        route_info['dest'].append(route['dest'])
+        route_info['airline'].append(route.get('airline', 'Unknown'))
+    
+    if not lengths:
+        raise HTTPException(status_code=404, detail="No routes with embeddings found")
+    embeddings_matrix = decode_embeddings(indices, values, lengths, EMBEDDING_DIM)
+    
+    # Reuse the vectorizer fitted at ingestion so query features line up with the
+    # stored embeddings; refit with the same parameters only if it is missing
+    if VECTORIZER_PATH.exists():
+        vectorizer = joblib.load(VECTORIZER_PATH)
+    else:
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 5), max_features=EMBEDDING_DIM)
+        vectorizer.fit(route_info['route_text'])
+    
+    return {
+        'vectorizer': vectorizer,
+        'embeddings': l2_normalize(embeddings_matrix),
+        'route_info': pa.table(route_info)
+    }
+
 @api_router.get("/recommendations/similar-routes")
 async def get_similar_routes(
     source: str = Query(..., description="Source airport IATA code"),
@@ -206,53 +183,27 @@ async def get_similar_routes(
     """Get similar route recommendations using vector similarity"""
     route_text = f"{source.upper()}-{destination.upper()}"
     
-    # Fetch all routes with embeddings
-    all_routes = await db.routes.find({"embedding": {"$exists": True}}, {"_id": 0}).to_list(length=None)
-    
-    if not all_routes:
-        raise HTTPException(status_code=404, detail="No routes with embeddings found")
-    
-    # Extract embeddings and route info
-    embeddings = []
-    route_info = []
-    
-    for route in all_routes:
-        try:
-            emb = pickle.loads(route['embedding'])
-            embeddings.append(emb)
-            route_info.append({
-                'route_text': route['route_text'],
-                'source': route['source'],
-                'dest': route['dest'],
-                'airline': route.get('airline', 'Unknown')
-            })
-        except:
-            continue
-    
-    if not embeddings:
-        raise HTTPException(status_code=404, detail="No valid embeddings found")
-    
-    # Create TF-IDF vectorizer with same parameters
-    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 5), max_features=128)
-    all_route_texts = [r['route_text'] for r in route_info]
-    vectorizer.fit(all_route_texts)
+    if not route_index:
+        route_index.update(await build_route_index())
+    vectorizer = route_index['vectorizer']
+    embeddings_matrix = route_index['embeddings']
+    route_info = route_index['route_info']
     
     # Transform query
-    query_vector = vectorizer.transform([route_text]).toarray()
+    query_vector = l2_normalize(vectorizer.transform([route_text])).toarray()[0]
     
-    # Stack embeddings
-    embeddings_matrix = np.vstack(embeddings)
+    # Embeddings are normalized at load time, so cosine similarity is a single sparse matvec
+    similarities = embeddings_matrix @ query_vector
     
-    # Compute cosine similarity
-    similarities = cosine_similarity(query_vector, embeddings_matrix)[0]
-    
-    # Get top K similar routes
-    top_indices = similarities.argsort()[-top_k:][::-1]
+    # Get top K similar routes with a partial sort, then order just those K
+    top_k = min(top_k, len(similarities))
+    top_indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+    top_indices = top_indices[np.argsort(-similarities[top_indices])]
     
     results = []
-    for idx in top_indices:
+    for route, idx in zip(route_info.take(top_indices).to_pylist(), top_indices):
         results.append({
-            **route_info[idx],
+            **route,
             'similarity': float(similarities[idx])
         })
     
@@ -264,6 +215,7 @@ async def get_direct_routes(
     destination: str = Query(..., description="Destination airport IATA code")
 ):
     """Get direct routes between two airports"""
+    db = get_db()
     query = {
         "source": source.upper(),
         "dest": destination.upper()
@@ -277,8 +229,8 @@ async def get_direct_routes(
 async def trigger_data_ingestion():
     """Trigger data ingestion (for admin use)"""
     try:
-        from data_ingestion import run_full_ingestion
         result = await run_full_ingestion()
+        load_route_index()
         return {"status": "success", "data": result}
     except Exception as e:
         logger.error(f"Data ingestion failed: {e}")
@@ -300,6 +252,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup_load_route_index():
+    load_route_index()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await close_client()
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Pipelined batch inserts used by the routes bulk load"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from data_ingestion import insert_batches
+
+
+class RecordingCollection:
+    """Collection stub that logs when each insert starts and finishes"""
+
+    def __init__(self, events):
+        self.events = events
+        self.inserted = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def insert_many(self, batch, ordered=True):
+        self.events.append(('start', batch[0]))
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.inserted.extend(batch)
+        self.in_flight -= 1
+        self.events.append(('end', batch[0]))
+
+
+def build_records(events, count):
+    for i in range(count):
+        events.append(('built', i))
+        yield i
+
+
+def test_inserts_start_before_last_batch_is_built():
+    events = []
+    collection = RecordingCollection(events)
+
+    asyncio.run(insert_batches(collection, build_records(events, 70), batch_size=10, max_in_flight=8))
+
+    first_start = events.index(('start', 0))
+    last_built = events.index(('built', 69))
+    assert first_start < last_built
+    assert collection.inserted == list(range(70))
+
+
+def test_in_flight_batches_are_bounded():
+    events = []
+    collection = RecordingCollection(events)
+
+    asyncio.run(insert_batches(collection, build_records(events, 100), batch_size=10, max_in_flight=2))
+
+    assert collection.peak_in_flight == 2
+    assert sorted(collection.inserted) == list(range(100))
+    # The seventh batch is only built once an earlier insert has freed its slot
+    assert events.index(('end', 0)) < events.index(('built', 60))
@@ -0,0 +1,49 @@
+"""Round trip of the sparse route embedding format stored in MongoDB"""
+import sys
+from array import array
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from data_ingestion import decode_embeddings, encode_embedding
+
+
+def decode_rows(encoded, dim):
+    """Concatenate stored rows into flat buffers the way the server fallback does"""
+    indices = bytearray()
+    values = bytearray()
+    lengths = array('I')
+    for embedding in encoded:
+        indices += embedding['indices']
+        values += embedding['values']
+        lengths.append(len(embedding['values']))
+    return decode_embeddings(indices, values, lengths, dim)
+
+
+def test_embedding_round_trip():
+    dense = np.array([
+        [0, 127, 0, 0, 5, 0],
+        [0, 0, 0, 0, 0, 0],
+        [42, 0, 0, 0, 0, 1]
+    ], dtype=np.int8)
+    quantized = sparse.csr_matrix(dense)
+
+    encoded = [encode_embedding(quantized, row) for row in range(quantized.shape[0])]
+    decoded = decode_rows(encoded, dense.shape[1])
+
+    assert encoded[0] == {'indices': b'\x01\x00\x04\x00', 'values': b'\x7f\x05'}
+    assert encoded[1] == {'indices': b'', 'values': b''}
+    assert decoded.dtype == np.int8
+    np.testing.assert_array_equal(decoded.toarray(), dense)
+
+
+def test_embedding_indices_beyond_one_byte():
+    dim = 300
+    quantized = sparse.csr_matrix(([-3, 9], ([0, 0], [2, dim - 1])), shape=(1, dim), dtype=np.int8)
+
+    decoded = decode_rows([encode_embedding(quantized, 0)], dim)
+
+    np.testing.assert_array_equal(decoded.toarray(), quantized.toarray())